@@ -1,27 +1,106 @@
 """API for FHEM homeautomation server, supporting telnet or HTTP/HTTPS connections with authentication and CSRF-token support."""
+
+import asyncio
+import base64
+import collections
 import datetime
+import functools
+import http.client
 import json
 import logging
+import queue
 import re
+import selectors
 import socket
-import errno
 import ssl
+import sys
 import threading
 import time
 
 from urllib.parse import quote
 from urllib.parse import urlencode
-from urllib.request import urlopen
+from urllib.error import HTTPError
 from urllib.error import URLError
-from urllib.request import HTTPSHandler
-from urllib.request import HTTPPasswordMgrWithDefaultRealm
-from urllib.request import HTTPBasicAuthHandler
-from urllib.request import build_opener
-from urllib.request import install_opener
+
+try:
+    # optional, faster json parser (pip install fhem[fast])
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # needs to be in sync with setup.py and documentation (conf.py, branch gh-pages)
 __version__ = "0.7.0"
 
+# Patterns used to convert FHEM's strings into int, float and datetime,
+# like '$' the numbers allow a trailing newline, int() and float() strip it.
+_INT_RE = re.compile(r"[0-9]+$")
+_FLOAT_RE = re.compile(r"[0-9]+\.[0-9]+$")
+_DT_RE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}")
+if hasattr(datetime.datetime, "fromisoformat"):
+    # C implementation, accepts FHEM's 'YYYY-MM-DD hh:mm:ss' timestamps
+    _parse_timestamp = datetime.datetime.fromisoformat
+else:  # Python 3.6
+
+    def _parse_timestamp(v):
+        # fixed width 'YYYY-MM-DD hh:mm:ss', slicing is much faster than strptime
+        if len(v) != 19 or v[4] != "-" or v[13] != ":":
+            raise ValueError("Invalid timestamp {}".format(v))
+        return datetime.datetime(
+            int(v[0:4]),
+            int(v[5:7]),
+            int(v[8:10]),
+            int(v[11:13]),
+            int(v[14:16]),
+            int(v[17:19]),
+        )
+
+
+@functools.lru_cache(maxsize=256)
+def _quote(cmd):
+    # Polling loops send the same few commands over and over
+    return quote(cmd)
+
+
+# CSRF token as found in FHEMWEB's html page
+_CSRF_RE = re.compile(rb"csrf_[A-Za-z0-9_]+")
+
+
+@functools.lru_cache(maxsize=8)
+def _ssl_context(cafile):
+    """SSL context for https and telnet with SSL, certificates are only checked if a cafile is given.
+
+    Contexts are shared by all connections with the same cafile, creating one
+    loads the system's trust store and the cafile.
+    """
+    context = ssl.create_default_context()
+    if cafile == "":
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        context.load_verify_locations(cafile=cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+@functools.lru_cache(maxsize=4)
+def _csrf_body(token):
+    # POST data for every command, changes only with the token
+    return urlencode({"fwcsrf": token}).encode("UTF-8")
+
+
+# None if the socket module doesn't define it for this platform
+_SO_BUSY_POLL = getattr(socket, "SO_BUSY_POLL", None)
+
+# Deprecated numeric loglevels of set_loglevel()
+_LOGLEVELS = {
+    0: logging.CRITICAL,
+    1: logging.ERROR,
+    2: logging.INFO,
+    3: logging.DEBUG,
+}
+
 
 class Fhem:
     """Connects to FHEM via socket communication with optional SSL and password
@@ -38,6 +117,7 @@ class Fhem:
         csrf=True,
         cafile="",
         loglevel=1,
+        busy_poll_us=0,
     ):
         """
         Instantiate connector object.
@@ -51,6 +131,7 @@ class Fhem:
         :param csrf: (http(s)) use csrf token (FHEM 5.8 and newer), default True
         :param cafile: path to public certificate of your root authority, if left empty, https protocol will ignore certificate checks.
         :param loglevel: deprecated, will be removed. Please use standard python logging API with logger 'Fhem'.
+        :param busy_poll_us: (telnet) default 0 (off). Busy poll the socket for up to busy_poll_us microseconds (SO_BUSY_POLL), if the socket module of the platform supports it.
         """
         self.log = logging.getLogger("Fhem")
 
@@ -60,6 +141,8 @@ class Fhem:
         self.ssl = use_ssl
         self.csrf = csrf
         self.csrftoken = ""
+        self._csrf_timestamp = 0
+        self._csrf_ttl = 600
         self.username = username
         self.password = password
         self.loglevel = loglevel
@@ -68,8 +151,13 @@ class Fhem:
         self.nolog = False
         self.bsock = None
         self.sock = None
-        self.https_handler = None
-        self.opener = None
+        self._sslctx = None
+        self._ssl_session = None
+        self._selector = None
+        self._recvbuf = bytearray(65536)
+        self._recvview = memoryview(self._recvbuf)
+        self.http_conn = None
+        self.busy_poll_us = busy_poll_us
 
         # Set LogLevel
         # self.set_loglevel(loglevel)
@@ -78,7 +166,7 @@ class Fhem:
         if protocol in validprots:
             self.protocol = protocol
         else:
-            self.log.error("Invalid protocol: {}".format(protocol))
+            self.log.error("Invalid protocol: %s", protocol)
 
         # Set authenticication values if#
         # the protocol is http(s) or use_ssl is True
@@ -88,31 +176,37 @@ class Fhem:
                 self.ssl = True
                 tmp_protocol = "https"
 
-            self.baseurlauth = "{}://{}:{}/".format(tmp_protocol, server, port)
-            self.baseurltoken = "{}fhem".format(self.baseurlauth)
-            self.baseurl = "{}fhem?XHR=1&cmd=".format(self.baseurlauth)
+            self.baseurlauth = f"{tmp_protocol}://{server}:{port}/"
+            self.baseurltoken = f"{self.baseurlauth}fhem"
+            self.baseurl = f"{self.baseurlauth}fhem?XHR=1&cmd="
+            # request paths on the persistent connection
+            self._tokenpath = "/fhem"
+            self._cmdpath = "/fhem?XHR=1&cmd="
 
             self._install_opener()
+        elif self.ssl:
+            self._sslctx = self._create_ssl_context()
 
     def connect(self):
         """create socket connection to server (telnet protocol only)"""
         if self.protocol == "telnet":
             # try:
             self.log.debug("Creating socket...")
+            self._close_selector()
             if self.ssl:
                 self.bsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
-                self.sock = context.wrap_socket(self.bsock)
+                self._set_socket_options(self.bsock)
+                # Passing the previous session allows TLS session resumption
+                self.sock = self._sslctx.wrap_socket(
+                    self.bsock, server_hostname=self.server, session=self._ssl_session
+                )
                 self.log.info(
-                    "Connecting to {}:{} with SSL (TLS)".format(self.server, self.port)
+                    "Connecting to %s:%s with SSL (TLS)", self.server, self.port
                 )
             else:
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.log.info(
-                    "Connecting to {}:{} without SSL".format(self.server, self.port)
-                )
+                self._set_socket_options(self.sock)
+                self.log.info("Connecting to %s:%s without SSL", self.server, self.port)
             # except Exception as e:
             #    self.connection = False
             #     self.log.error(
@@ -125,6 +219,8 @@ class Fhem:
             # self.sock.timeout = 5.0
             self.sock.connect((self.server, self.port))
             self.log.debug("post-connect")
+            if self.ssl:
+                self._ssl_session = self.sock.session
             # except Exception as e:
             #     self.connection = False
             #     self.log.error(
@@ -132,38 +228,43 @@ class Fhem:
             #     )
             #     return
             self.connection = True
-            self.log.info("Connected to {}:{}".format(self.server, self.port))
+            self.log.info("Connected to %s:%s", self.server, self.port)
 
             if self.password != "":
-                # time.sleep(1.0)
-                # self.send_cmd("\n")
-                # prmpt = self._recv_nonblocking(4.0)
-                prmpt = self.sock.recv(32000)
-                self.log.debug("auth-prompt: {}".format(prmpt))
+                # FHEM's telnet sends 'Password: ' and answers a correct
+                # password with a line break.
+                try:
+                    prmpt = self._read_until(b"Password: ", 5.0)
+                    self.log.debug("auth-prompt: %s", prmpt)
 
-                self.nolog = True
-                self.send_cmd(self.password)
-                self.nolog = False
-                time.sleep(0.1)
+                    self.nolog = True
+                    self.send_cmd(self.password)
+                    self.nolog = False
 
-                try:
-                    po1 = self.sock.recv(32000)
-                    self.log.debug("auth-repl1: {}".format(po1))
+                    po1 = self._read_until(b"\n", 5.0)
+                    self.log.debug("auth-repl1: %s", po1)
                 except socket.error:
+                    po1 = b""
+                if b"\n" not in po1:
                     self.log.error("Failed to recv auth reply")
                     self.connection = False
                     return
-                self.log.info("Auth password sent to {}".format(self.server))
+                self.log.info("Auth password sent to %s", self.server)
         else:  # http(s)
-            if self.csrf:
+            if (
+                self.csrf
+                and self.csrftoken != ""
+                and time.time() - self._csrf_timestamp < self._csrf_ttl
+            ):
+                # Reuse cached token, it is renewed if the server rejects it.
+                self.connection = True
+            elif self.csrf:
                 dat = self.send("")
                 if dat is not None:
-                    dat = dat.decode("UTF-8")
-                    stp = dat.find("csrf_")
-                    if stp != -1:
-                        token = dat[stp:]
-                        token = token[: token.find("'")]
-                        self.csrftoken = token
+                    mtch = _CSRF_RE.search(dat)
+                    if mtch is not None:
+                        self.csrftoken = mtch.group(0).decode("ascii")
+                        self._csrf_timestamp = time.time()
                         self.connection = True
                     else:
                         self.log.error(
@@ -186,201 +287,313 @@ class Fhem:
         self.log.warning(
             "Deprecation: please set logging levels using python's standard logging for logger 'Fhem'"
         )
-        if level == 0:
-            self.log.setLevel(logging.CRITICAL)
-        elif level == 1:
-            self.log.setLevel(logging.ERROR)
-        elif level == 2:
-            self.log.setLevel(logging.INFO)
-        elif level == 3:
-            self.log.setLevel(logging.DEBUG)
+        if level in _LOGLEVELS:
+            self.log.setLevel(_LOGLEVELS[level])
+
+    def _set_socket_options(self, sock):
+        # FHEM telnet sessions send short interactive commands, Nagle's
+        # algorithm would only add latency (TCP_NODELAY). Keepalive detects
+        # dead connections of long idle sessions, e.g. event listeners.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.busy_poll_us > 0:
+            if _SO_BUSY_POLL is None:
+                self.log.warning("SO_BUSY_POLL is not supported on this platform")
+                return
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, _SO_BUSY_POLL, self.busy_poll_us)
+            except OSError as err:
+                self.log.warning("Failed to set SO_BUSY_POLL: %s", err)
 
     def close(self):
         """Closes socket connection. (telnet only)"""
         if self.protocol == "telnet":
             if self.connected():
-                time.sleep(0.2)
+                if self.ssl and self.sock.session is not None:
+                    # TLS 1.3 session tickets are only available after the
+                    # handshake. None once the TLS layer is gone, e.g. after
+                    # FhemEventQueue.close() shut the socket down.
+                    self._ssl_session = self.sock.session
+                # Half-close and give the server up to 0.2 sec to process
+                # outstanding commands and to close its side.
+                deadline = time.time() + 0.2
+                try:
+                    if self.ssl:
+                        # TLS close_notify, servers only keep the session for
+                        # resumption if the connection was shut down cleanly.
+                        self.sock.settimeout(0.2)
+                        self.sock.unwrap()
+                    self.sock.shutdown(socket.SHUT_WR)
+                    while self._readable(max(deadline - time.time(), 0)):
+                        if len(self._recv_chunk()) == 0 or time.time() > deadline:
+                            break
+                except (OSError, ValueError):
+                    # ValueError: no SSL wrapper left, the socket was shut down
+                    pass
+                self._close_selector()
                 self.sock.close()
                 self.connection = False
                 self.log.info("Disconnected from fhem-server")
             else:
                 self.log.error("Cannot disconnect, not connected")
         else:
+            if self.http_conn is not None:
+                self.http_conn.close()
+                self.http_conn = None
             self.connection = False
 
     def _install_opener(self):
-        self.opener = None
-        self.auth_handler = None
-        self.password_mgr = None
+        self.http_conn = None
+        self.auth_header = None
         self.context = None
         if self.username != "":
-            self.password_mgr = HTTPPasswordMgrWithDefaultRealm()
-            self.password_mgr.add_password(
-                None, self.baseurlauth, self.username, self.password
+            credentials = "{}:{}".format(self.username, self.password).encode("UTF-8")
+            self.auth_header = "Basic {}".format(
+                base64.b64encode(credentials).decode("ascii")
             )
-            self.auth_handler = HTTPBasicAuthHandler(self.password_mgr)
         if self.ssl is True:
-            if self.cafile == "":
-                self.context = ssl.create_default_context()
-                self.context.check_hostname = False
-                self.context.verify_mode = ssl.CERT_NONE
-            else:
-                self.context = ssl.create_default_context()
-                self.context.load_verify_locations(cafile=self.cafile)
-                self.context.verify_mode = ssl.CERT_REQUIRED
-            self.https_handler = HTTPSHandler(context=self.context)
-            if self.username != "":
-                self.opener = build_opener(self.https_handler, self.auth_handler)
-            else:
-                self.opener = build_opener(self.https_handler)
+            self.context = self._create_ssl_context()
+
+    def _create_ssl_context(self):
+        return _ssl_context(self.cafile)
+
+    def _http_request(self, path, paramdata, timeout):
+        """Send a request via the persistent http(s) connection, the connection
+        is kept alive and reused for subsequent requests.
+
+        :param path: request path, e.g. '/fhem?XHR=1&cmd=...'
+        :param paramdata: urlencoded POST data or None for GET
+        :param timeout: timeout for the request (sec)
+        :return: body of the response (bytes)
+        """
+        headers = {"Connection": "keep-alive"}
+        if self.auth_header is not None:
+            headers["Authorization"] = self.auth_header
+        if paramdata is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            method = "POST"
         else:
-            if self.username != "":
-                self.opener = build_opener(self.auth_handler)
-        # if self.opener is not None:
-        #     self.log.debug("Setting up opener on: {}".format(self.baseurlauth))
-        #     install_opener(self.opener)
+            method = "GET"
+        while True:
+            reused = self.http_conn is not None
+            if reused:
+                self.http_conn.timeout = timeout
+                if self.http_conn.sock is not None:
+                    self.http_conn.sock.settimeout(timeout)
+            elif self.ssl is True:
+                self.http_conn = http.client.HTTPSConnection(
+                    self.server, self.port, timeout=timeout, context=self.context
+                )
+            else:
+                self.http_conn = http.client.HTTPConnection(
+                    self.server, self.port, timeout=timeout
+                )
+            try:
+                self.http_conn.request(method, path, body=paramdata, headers=headers)
+                ans = self.http_conn.getresponse()
+                data = ans.read()
+            except (OSError, http.client.HTTPException) as err:
+                self.http_conn.close()
+                self.http_conn = None
+                if reused and isinstance(
+                    err, (ConnectionError, http.client.RemoteDisconnected)
+                ):
+                    # Server closed the kept-alive connection, open a new one
+                    self.log.debug("HTTP connection closed by server, reconnecting")
+                    continue
+                raise URLError(err)
+            if ans.will_close:
+                self.http_conn.close()
+                self.http_conn = None
+            if ans.status < 200 or ans.status > 299:
+                raise HTTPError(
+                    "{}{}".format(self.baseurlauth, path[1:]),
+                    ans.status,
+                    ans.reason,
+                    ans.headers,
+                    None,
+                )
+            return data
 
     def send(self, buf, timeout=10):
         """Sends a buffer to server
 
         :param buf: binary buffer"""
+        # Dispatched per call, not bound at construction: subclasses and
+        # monkeypatches override send(), send_cmd() always sends through it.
+        if self.protocol == "telnet":
+            return self._send_telnet(buf, timeout)
+        return self._send_http(buf, timeout)
+
+    def _send_telnet(self, buf, timeout=10):
         if len(buf) > 0:
-            if not self.connected():
+            if not self.connection:
                 self.log.debug("Not connected, trying to connect...")
                 self.connect()
-        if self.protocol == "telnet":
-            if self.connected():
-                self.log.debug("Connected, sending...")
-                try:
-                    self.sock.sendall(buf)
-                    self.log.info("Sent msg, len={}".format(len(buf)))
-                    return None
-                except OSError as err:
-                    self.log.error(
-                        "Failed to send msg, len={}. Exception raised: {}".format(
-                            len(buf), err
-                        )
-                    )
-                    self.connection = None
-                    return None
-            else:
+        if self.connection:
+            self.log.debug("Connected, sending...")
+            try:
+                self.sock.sendall(buf)
+                self.log.info("Sent msg, len=%s", len(buf))
+                return None
+            except OSError as err:
                 self.log.error(
-                    "Failed to send msg, len={}. Not connected.".format(len(buf))
+                    "Failed to send msg, len=%s. Exception raised: %s", len(buf), err
                 )
+                self.connection = None
                 return None
-        else:  # HTTP(S)
-            paramdata = None
-            # if self.opener is not None:
-            #     install_opener(self.opener)
-
-            if self.csrf and len(buf) > 0:
-                if len(self.csrftoken) == 0:
-                    self.log.error("CSRF token not available!")
-                    self.connection = False
-                else:
-                    datas = {"fwcsrf": self.csrftoken}
-                    paramdata = urlencode(datas).encode("UTF-8")
+        else:
+            self.log.error("Failed to send msg, len=%s. Not connected.", len(buf))
+            return None
 
-            # try:
-            if len(buf) > 0:
-                self.log.debug("Cmd: {}".format(buf))
-                cmd = quote(buf)
-                self.log.debug("Cmd-enc: {}".format(cmd))
-            else:
-                cmd = ""
-            if len(cmd) > 0:
-                ccmd = self.baseurl + cmd
-            else:
-                ccmd = self.baseurltoken
+    def _send_http(self, buf, timeout=10):
+        if len(buf) > 0:
+            if not self.connection:
+                self.log.debug("Not connected, trying to connect...")
+                self.connect()
+        paramdata = None
 
-            self.log.info("Request: {}".format(ccmd))
-            if ccmd.lower().startswith("http"):
-                if self.opener is not None:
-                    ans = self.opener.open(ccmd, paramdata, timeout=timeout)
-                else:
-                    if self.context is None:
-                        ans = urlopen(ccmd, paramdata, timeout=timeout)
-                    else:
-                        ans = urlopen(
-                            ccmd, paramdata, timeout=timeout, context=self.context
-                        )
+        if self.csrf and len(buf) > 0:
+            if len(self.csrftoken) == 0:
+                self.log.error("CSRF token not available!")
+                self.connection = False
             else:
-                self.log.error(
-                    "Invalid URL {}, Failed to send msg, len={}, {}".format(
-                        ccmd, len(buf), err
-                    )
-                )
-                return None
-            data = ans.read()
-            return data
-            # except URLError as err:
-            #     self.connection = False
-            #     self.log.error("Failed to send msg, len={}, {}".format(len(buf), err))
-            #     return None
-            # except socket.timeout as err:
-            #     # Python 2.7 fix
-            #     self.log.error("Failed to send msg, len={}, {}".format(len(buf), err))
-            #     return None
+                paramdata = _csrf_body(self.csrftoken)
+
+        if len(buf) > 0:
+            self.log.debug("Cmd: %s", buf)
+            cmd = _quote(buf)
+            self.log.debug("Cmd-enc: %s", cmd)
+        else:
+            cmd = ""
+        if len(cmd) > 0:
+            path = self._cmdpath + cmd
+        else:
+            path = self._tokenpath
+
+        self.log.info("Request: %s%s", self.baseurlauth, path[1:])
+        try:
+            return self._http_request(path, paramdata, timeout)
+        except HTTPError as err:
+            if paramdata is None or err.code not in (400, 403):
+                raise
+            # FHEM rejects stale CSRF tokens, get a new one and retry once
+            self.log.info("CSRF token rejected (%s), renewing", err.code)
+            self.csrftoken = ""
+            self.connection = False
+            self.connect()
+            if len(self.csrftoken) == 0:
+                raise
+            paramdata = _csrf_body(self.csrftoken)
+            return self._http_request(path, paramdata, timeout)
 
     def send_cmd(self, msg, timeout=10.0):
         """Sends a command to server.
 
-        :param msg: string with FHEM command, e.g. 'set lamp on'
+        :param msg: string with FHEM command, e.g. 'set lamp on', or the UTF-8 encoded bytes (bytearray, memoryview) of it, which saves encoding commands that are sent repeatedly (b'set lamp on')
         :param timeout: timeout on send (sec).
         """
-        if not self.connected():
-            self.connect()
-        if not self.nolog:
-            self.log.debug("Sending: {}".format(msg))
         if self.protocol == "telnet":
-            if self.connection:
-                msg = "{}\n".format(msg)
-                cmd = msg.encode("utf-8")
-                return self.send(cmd)
-            else:
-                self.log.error(
-                    "Failed to send msg, len={}. Not connected.".format(len(msg))
-                )
-                return None
-        else:
-            return self.send(msg, timeout=timeout)
+            return self._send_cmd_telnet(msg, timeout)
+        return self._send_cmd_http(msg, timeout)
+
+    def _send_cmd_telnet(self, msg, timeout=10.0):
+        if not self.nolog:
+            self.log.debug("Sending: %s", msg)
+        if isinstance(msg, (bytes, bytearray, memoryview)):
+            return self.send(b"".join((msg, b"\n")))
+        return self.send(msg.encode("utf-8") + b"\n")
+
+    def _send_cmd_http(self, msg, timeout=10.0):
+        if not self.nolog:
+            self.log.debug("Sending: %s", msg)
+        if isinstance(msg, (bytearray, memoryview)):
+            # hashable for the quote cache
+            msg = bytes(msg)
+        return self.send(msg, timeout=timeout)
+
+    def _close_selector(self):
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+
+    def _readable(self, timeout):
+        """Wait until the telnet socket has data or timeout (sec) expires."""
+        if self._selector is None:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self.sock, selectors.EVENT_READ)
+        # select() doesn't see data that is already buffered by the SSL layer
+        if self.ssl and self.sock.pending() > 0:
+            return True
+        return len(self._selector.select(timeout)) > 0
+
+    def _recv_chunk(self):
+        """Receive one chunk from the telnet socket via the reusable receive buffer."""
+        n = self.sock.recv_into(self._recvview)
+        return bytes(self._recvview[:n])
+
+    def _read_until(self, token, timeout):
+        """Receive from the telnet socket until token arrived or timeout (sec) expired."""
+        data = b""
+        deadline = time.monotonic() + timeout
+        while token not in data:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._readable(remaining):
+                break
+            datai = self._recv_chunk()
+            if len(datai) == 0:
+                break
+            data += datai
+        return data
 
     def _recv_nonblocking(self, timeout=0.1):
-        if not self.connected():
+        if not self.connection:
             self.connect()
-        data = b""
+        chunks = []
         if self.connection:
-            self.sock.setblocking(False)
-            data = b""
+            # Read until no more data arrives within timeout
+            while self._readable(timeout):
+                try:
+                    datai = self._recv_chunk()
+                except socket.error as err:
+                    self.log.debug("Exception in non-blocking. Error: %s", err)
+                    break
+                if len(datai) == 0:
+                    break
+                chunks.append(datai)
+        return b"".join(chunks)
+
+    def _recv_reply(self, timeout, chunks):
+        """Receive a telnet reply, stops as soon as a complete JSON document has
+        arrived, other replies end when no more data arrives within timeout (sec).
+
+        :return: tuple of the reply (bytes) and the decoded JSON or None
+        """
+        while self._readable(timeout):
             try:
-                data = self.sock.recv(32000)
+                datai = self._recv_chunk()
             except socket.error as err:
-                # Resource temporarily unavailable, operation did not complete are expected
-                if err.errno != errno.EAGAIN and err.errno != errno.ENOENT:
-                    self.log.debug(
-                        "Exception in non-blocking (1). Error: {}".format(err)
-                    )
-                time.sleep(timeout)
-
-            wok = 1
-            while len(data) > 0 and wok > 0:
-                time.sleep(timeout)
-                datai = b""
+                self.log.debug("Exception in non-blocking. Error: %s", err)
+                break
+            if len(datai) == 0:
+                break
+            chunks.append(datai)
+            # Only attempt to decode when the reply might be complete: nested
+            # jsonlist2 output has chunks ending in '}' before the end, large
+            # replies would be parsed over and over while still arriving.
+            # The closing brace of FHEM's indented output isn't indented.
+            end = datai.rstrip()
+            if (
+                end.endswith(b"}")
+                and end[-2:-1] not in (b" ", b"\t")
+                and not self._readable(0)
+            ):
+                data = b"".join(chunks)
                 try:
-                    datai = self.sock.recv(32000)
-                    if len(datai) == 0:
-                        wok = 0
-                    else:
-                        data += datai
-                except socket.error as err:
-                    # Resource temporarily unavailable, operation did not complete are expected
-                    if err.errno != errno.EAGAIN and err.errno != errno.ENOENT:
-                        self.log.debug(
-                            "Exception in non-blocking (2). Error: {}".format(err)
-                        )
-                    wok = 0
-            self.sock.setblocking(True)
-        return data
+                    return data, _json_loads(data)
+                except ValueError:
+                    pass
+        return b"".join(chunks), None
 
     def send_recv_cmd(self, msg, timeout=0.1, blocking=False):
         """
@@ -391,28 +604,24 @@ class Fhem:
         :param blocking: (telnet only) on True: use blocking socket communication (bool)
         """
         data = b""
-        if not self.connected():
+        jdata = None
+        if not self.connection:
             self.connect()
         if self.protocol == "telnet":
             if self.connection:
                 self.send_cmd(msg)
-                time.sleep(timeout)
-                data = []
+                # returns as soon as the reply starts to arrive
+                self._readable(timeout)
+                chunks = []
                 if blocking is True:
                     try:
-                        # This causes failures if reply is larger!
-                        data = self.sock.recv(64000)
-                    except socket.error:
-                        self.log.error("Failed to recv msg. {}".format(data))
+                        chunks.append(self._recv_chunk())
+                    except socket.error as err:
+                        self.log.error("Failed to recv msg. %s", err)
                         return {}
-                else:
-                    data = self._recv_nonblocking(timeout)
-
-                self.sock.setblocking(True)
+                data, jdata = self._recv_reply(timeout, chunks)
             else:
-                self.log.error(
-                    "Failed to send msg, len={}. Not connected.".format(len(msg))
-                )
+                self.log.error("Failed to send msg, len=%s. Not connected.", len(msg))
         else:
             data = self.send_cmd(msg)
             if data is None:
@@ -421,14 +630,15 @@ class Fhem:
         if len(data) == 0:
             return {}
 
-        try:
-            sdata = data.decode("utf-8")
-            jdata = json.loads(sdata)
-        except Exception as err:
-            self.log.error(
-                "Failed to decode json, exception raised. {} {}".format(data, err)
-            )
-            return {}
+        if jdata is None:
+            try:
+                jdata = _json_loads(data)
+            except ValueError as err:
+                # also UnicodeDecodeError and orjson.JSONDecodeError
+                self.log.error(
+                    "Failed to decode json, exception raised. %s %s", data, err
+                )
+                return {}
         if len(jdata["Results"]) == 0:
             self.log.error("Query had no result.")
             return {}
@@ -490,80 +700,111 @@ class Fhem:
 
     @staticmethod
     def _sand_down(value):
-        return value if len(value.values()) - 1 else list(value.values())[0]
+        return value if len(value) != 1 else next(iter(value.values()))
 
     @staticmethod
-    def _append_filter(name, value, compare, string, filter_list):
-        value_list = [value] if isinstance(value, str) else value
-        values = ",".join(value_list)
-        filter_list.append(string.format(name, compare, values))
+    def _append_filter(name, value, compare, filter_list):
+        values = value if isinstance(value, str) else ",".join(value)
+        filter_list.append(f"{name}{compare}{values}")
 
     def _response_filter(self, response, arg, value, value_only=None, time_only=None):
         if len(arg) > 2:
             self.log.error("Too many positional arguments")
             return {}
+        # not connected or nothing found
+        if not response:
+            return {}
+        # Look up requested keys directly instead of testing every key
+        if len(arg) and isinstance(arg[0], str):
+            keys = (arg[0],)
+        elif len(arg):
+            keys = arg[0]
+        else:
+            keys = None
+        # value_only/time_only select one field of each reading
+        field = "Value" if value_only else "Time" if time_only else None
         result = {}
         for r in (
             response if "totalResultsReturned" not in response else response["Results"]
         ):
-            arg = [arg[0]] if len(arg) and isinstance(arg[0], str) else arg
-            if value_only:
-                result[r["Name"]] = {
-                    k: v["Value"]
-                    for k, v in r[value].items()
-                    if "Value" in v and (not len(arg) or (len(arg) and k == arg[0]))
-                }  # k in arg[0]))} fixes #14
-            elif time_only:
-                result[r["Name"]] = {
-                    k: v["Time"]
-                    for k, v in r[value].items()
-                    if "Time" in v and (not len(arg) or (len(arg) and k == arg[0]))
-                }  # k in arg[0]))}
+            items = r[value]
+            if keys is not None:
+                items = {k: items[k] for k in keys if k in items}
+            if field is not None:
+                found = {k: v[field] for k, v in items.items() if field in v}
             else:
-                result[r["Name"]] = {
-                    k: v
-                    for k, v in r[value].items()
-                    if (not len(arg) or (len(arg) and k == arg[0]))
-                }  # k in arg[0]))}
-            if not result[r["Name"]]:
-                result.pop(r["Name"], None)
-            elif len(result[r["Name"]].values()) == 1:
-                result[r["Name"]] = list(result[r["Name"]].values())[0]
+                found = dict(items)
+            if len(found) == 1:
+                result[r["Name"]] = next(iter(found.values()))
+            elif found:
+                result[r["Name"]] = found
         return result
 
-    def _parse_filters(self, name, value, not_value, filter_list, case_sensitive):
+    @staticmethod
+    def _parse_filters(name, value, not_value, filter_list, case_sensitive):
         compare = "=" if case_sensitive else "~"
         if value:
-            self._append_filter(name, value, compare, "{}{}{}", filter_list)
+            Fhem._append_filter(name, value, compare, filter_list)
         elif not_value:
-            self._append_filter(name, not_value, compare, "{}!{}{}", filter_list)
+            Fhem._append_filter(name, not_value, f"!{compare}", filter_list)
 
-    def _convert_data(self, response, k, v):
+    @staticmethod
+    def _hashable(value):
+        # devspec values are joined with ',', any iterable (list, set, ...)
+        # gives the same result as a tuple of its items
+        if value is None or isinstance(value, str):
+            return value
         try:
-            test_type = unicode
-        except NameError:
-            test_type = str
-        if isinstance(v, test_type):
-            if re.findall("^[0-9]+$", v):
-                response[k] = int(v)
-            elif re.findall(r"^[0-9]+\.[0-9]+$", v):
-                response[k] = float(v)
-            elif re.findall(
-                "^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}$", v
-            ):
-                response[k] = datetime.datetime.strptime(v, "%Y-%m-%d %H:%M:%S")
-        if isinstance(v, dict):
-            self._parse_data_types(response[k])
-        if isinstance(v, list):
-            self._parse_data_types(response[k])
+            return tuple(value)
+        except TypeError:
+            return value
+
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def _build_cmd(filter_args, filters, case_sensitive):
+        # Cached, polling clients repeat the same queries
+        filter_list = []
+        for name, value, not_value in filter_args:
+            Fhem._parse_filters(name, value, not_value, filter_list, case_sensitive)
+        if filters:
+            compare = "=" if case_sensitive else "~"
+            for key, value in filters:
+                filter_list.append(f"{key}{compare}{value}")
+        return "jsonlist2 {}".format(":FILTER=".join(filter_list))
+
+    @staticmethod
+    def _convert_str(v):
+        """Convert FHEM string to int, float or datetime, returns v if not convertible."""
+        if _INT_RE.match(v):
+            return int(v)
+        if _FLOAT_RE.match(v):
+            return float(v)
+        if len(v) == 19 and v[4] == "-" and _DT_RE.fullmatch(v):
+            try:
+                return _parse_timestamp(v)
+            except ValueError:
+                # e.g. month 13
+                pass
+        return v
 
     def _parse_data_types(self, response):
-        if isinstance(response, dict):
-            for k, v in response.items():
-                self._convert_data(response, k, v)
-        if isinstance(response, list):
-            for i, v in enumerate(response):
-                self._convert_data(response, i, v)
+        # Iterative walk over the nested FHEM response, converts values in place
+        stack = [response]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                items = node.items()
+            elif isinstance(node, list):
+                items = enumerate(node)
+            else:
+                continue
+            for k, v in items:
+                if isinstance(v, str):
+                    # values that don't start with a digit can't be numbers or dates
+                    if v and v[0] in "0123456789":
+                        node[k] = self._convert_str(v)
+                elif isinstance(v, (dict, list)):
+                    stack.append(v)
 
     def get(
         self,
@@ -606,23 +847,26 @@ class Fhem:
         :param blocking: telnet socket mode, default blocking=False
         :return: dict of FHEM devices
         """
-        if not self.connected():
+        if not self.connection:
             self.connect()
-        if self.connected():
-            filter_list = []
-            self._parse_filters("NAME", name, not_name, filter_list, case_sensitive)
-            self._parse_filters("STATE", state, not_state, filter_list, case_sensitive)
-            self._parse_filters("group", group, not_group, filter_list, case_sensitive)
-            self._parse_filters("room", room, not_room, filter_list, case_sensitive)
-            self._parse_filters(
-                "TYPE", device_type, not_device_type, filter_list, case_sensitive
+        if self.connection:
+            freeze = self._hashable
+            cmd = self._build_cmd(
+                (
+                    ("NAME", freeze(name), freeze(not_name)),
+                    ("STATE", freeze(state), freeze(not_state)),
+                    ("group", freeze(group), freeze(not_group)),
+                    ("room", freeze(room), freeze(not_room)),
+                    ("TYPE", freeze(device_type), freeze(not_device_type)),
+                ),
+                # values are formatted as they are, e.g. ['x'] stays "['x']"
+                (
+                    tuple((k, "{}".format(v)) for k, v in filters.items())
+                    if filters
+                    else None
+                ),
+                case_sensitive,
             )
-            if filters:
-                for key, value in filters.items():
-                    filter_list.append(
-                        "{}{}{}".format(key, "=" if case_sensitive else "~", value)
-                    )
-            cmd = "jsonlist2 {}".format(":FILTER=".join(filter_list))
             if self.protocol == "telnet":
                 result = self.send_recv_cmd(cmd, blocking=blocking, timeout=timeout)
             else:
@@ -644,8 +888,9 @@ class Fhem:
         :return: dict of FHEM devices with states
         """
         response = self.get(**kwargs)
+        # not connected or nothing found
         if not response:
-            return response
+            return {}
         return {
             r["Name"]: r["Readings"]["state"]["Value"]
             for r in response
@@ -722,10 +967,55 @@ class Fhem:
         :param arg: str for one reading, list for special readings, empty for all readings
         :param kwargs: use keyword arguments from :py:meth:`Fhem.get` and :py:meth:`Fhem.get_readings` functions
         :return: str, int, float when only specific value requested else dict
+
+        To poll readings of several devices, use :py:meth:`Fhem.get_many`, which needs only one request.
         """
         result = self.get_readings(*arg, name=device, **kwargs)
         return self._sand_down(result)
 
+    def get_many(self, specs, value_only=None, time_only=None, **kwargs):
+        """
+        Get readings of several devices with a single request to FHEM.
+
+        :param specs: list of (device, reading) tuples, both are regular expressions, e.g. [("lamp.*", "state"), ("clima", "temperature|humidity")]
+        :param value_only: return only value of readings, not timestamp
+        :param time_only: return only timestamp of readings
+        :param kwargs: use keyword arguments from :py:meth:`Fhem.get` function (except name and raw_result)
+        :return: dict with the spec tuples as keys, values are dicts of FHEM devices with their matching readings
+        """
+        if "name" in kwargs:
+            self.log.error("get_many: devices are selected by specs, name not allowed")
+            return {}
+        if kwargs.pop("raw_result", None):
+            self.log.error("get_many: raw_result is not supported")
+            return {}
+        name = "({})".format("|".join(device for device, _ in specs))
+        response = self.get(name=name, **kwargs)
+        # FHEM matches device regexes case-insensitive unless case_sensitive is set
+        flags = 0 if kwargs.get("case_sensitive") else re.IGNORECASE
+        # value_only/time_only select one field of each reading
+        field = "Value" if value_only else "Time" if time_only else None
+        result = {}
+        for spec in specs:
+            device_re = re.compile(spec[0], flags)
+            reading_re = re.compile(spec[1])
+            devices = {}
+            for r in response or []:
+                if not device_re.fullmatch(r["Name"]):
+                    continue
+                readings = {}
+                for k, v in r["Readings"].items():
+                    if not reading_re.fullmatch(k):
+                        continue
+                    if field is None:
+                        readings[k] = v
+                    elif field in v:
+                        readings[k] = v[field]
+                if readings:
+                    devices[r["Name"]] = readings
+            result[spec] = devices
+        return result
+
     def get_device_attribute(self, device, *arg, **kwargs):
         """
         Get attribute(s) of one device
@@ -751,6 +1041,128 @@ class Fhem:
         return self._sand_down(result)
 
 
+_event_log = logging.getLogger("FhemEventQueue")
+
+# Compact event record, see FhemEventQueue's event_tuples option
+FhemEvent = collections.namedtuple(
+    "FhemEvent", "timestamp devicetype device reading value unit"
+)
+
+
+def _parse_event_time(date, time_of_day, line):
+    """Slow path for event timestamps that fromisoformat doesn't accept."""
+    dd = date.split("-")
+    tt = time_of_day.split(":")
+    try:
+        if "." in tt[2]:
+            secs = float(tt[2])
+            tt[2] = str(int(secs))
+            tt.append(str(int((secs - int(secs)) * 1000000)))
+    except (IndexError, ValueError) as e:
+        _event_log.warning("EventQueue: us-Bugfix failed with %s", e)
+    try:
+        if len(tt) == 3:
+            dt = datetime.datetime(
+                int(dd[0]),
+                int(dd[1]),
+                int(dd[2]),
+                int(tt[0]),
+                int(tt[1]),
+                int(tt[2]),
+            )
+        else:
+            dt = datetime.datetime(
+                int(dd[0]),
+                int(dd[1]),
+                int(dd[2]),
+                int(tt[0]),
+                int(tt[1]),
+                int(tt[2]),
+                int(tt[3]),
+            )
+    except (IndexError, ValueError) as e:
+        _event_log.debug(
+            "EventQueue: invalid date format in date=%s time=%s, event %s ignored: %s",
+            date,
+            time_of_day,
+            line,
+            e,
+        )
+        return None
+    return dt
+
+
+def _compile_filters(filterlist):
+    """(devtype, device, reading) tuple per filter, None matches everything."""
+    if filterlist is None:
+        return None
+    return [(f.get("devtype"), f.get("device"), f.get("reading")) for f in filterlist]
+
+
+def _parse_inform_line(
+    line, filters, raw_value, event_tuples=False, raw_timestamp=False
+):
+    """Parse one line of FHEM's 'inform timer' output.
+
+    :param line: bytes, one event line without the newline
+    :param filters: list of (devtype, device, reading) tuples or None, None entries match everything
+    :param raw_value: if True, don't split the value into value and unit
+    :param event_tuples: if True, return a FhemEvent instead of a dictionary
+    :param raw_timestamp: if True, keep the timestamp as FHEM's string instead of a datetime
+    :return: event dictionary or FhemEvent, or None for invalid or filtered lines
+    """
+    # Lines are split on b"\n" before decoding, a multi-byte UTF-8 sequence
+    # never contains that byte. Invalid UTF-8 must not stop the event thread.
+    l = line.decode("utf-8", "replace")
+    # date time devtype device, rest is the event text
+    li = l.split(" ", 4)
+    if len(li) != 5:
+        return None
+    if raw_timestamp is True:
+        dt = li[0] + " " + li[1]
+    else:
+        try:
+            dt = _parse_timestamp(li[0] + " " + li[1])
+        except ValueError:
+            dt = _parse_event_time(li[0], li[1], l)
+            if dt is None:
+                return None
+    # names repeat with every event, interned they are stored only once
+    devtype = sys.intern(li[2])
+    dev = sys.intern(li[3])
+    rest = li[4]
+    head, _, tail = rest.partition(" ")
+    if head.endswith(":"):
+        read = sys.intern(head[:-1])
+        val, _, unit = tail.partition(" ")
+        unit = unit.partition(" ")[0]
+    else:
+        read = "STATE"
+        val = head
+        unit = tail.partition(" ")[0]
+
+    if filters is not None and not any(
+        (ft is None or ft == devtype)
+        and (fd is None or fd == dev)
+        and (fr is None or fr == read)
+        for ft, fd, fr in filters
+    ):
+        return None
+    if raw_value is not False:
+        val = rest
+        unit = None
+    if event_tuples is True:
+        return FhemEvent(dt, devtype, dev, read, val, unit)
+    return {
+        "timestamp": dt,
+        "devicetype": devtype,
+        "device": dev,
+        "reading": read,
+        "value": val,
+        "unit": unit,
+    }
+
+
 class FhemEventQueue:
     """Creates a thread that listens to FHEM events and dispatches them to
     a Python queue."""
@@ -772,12 +1184,15 @@ class FhemEventQueue:
         serverregex=None,
         loglevel=1,
         raw_value=False,
+        event_tuples=False,
+        busy_poll_us=0,
+        timestamp_format="datetime",
     ):
         """
         Construct an event queue object, FHEM events will be queued into the queue given at initialization.
 
         :param server: FHEM server address
-        :param que: Python Queue object, receives FHEM events as dictionaries
+        :param que: Python Queue object, receives FHEM events as dictionaries. Alternatively a collections.deque, events are appended without locking (consumers use popleft(), a deque with maxlen drops the oldest events).
         :param port: FHEM telnet port
         :param protocol: 'telnet', 'http' or 'https'. NOTE: for FhemEventQueue, currently only 'telnet' is supported!
         :param use_ssl: boolean for SSL (TLS)
@@ -791,9 +1206,14 @@ class FhemEventQueue:
         :param serverregex: FHEM regex to restrict event messages on server side.
         :param loglevel: deprecated, will be removed. Use standard python logging function for logger 'FhemEventQueue', old: 0: no log, 1: errors, 2: info, 3: debug
         :param raw_value: default False. On True, the value of a reading is not parsed for units, and returned as-is.
+        :param event_tuples: default False. On True, events are queued as FhemEvent namedtuples (same fields as the dictionaries, ev.device instead of ev["device"]), which use about a third of the memory.
+        :param busy_poll_us: default 0 (off). Linux, if the socket module supports it: busy poll the event socket for up to busy_poll_us microseconds (SO_BUSY_POLL), lower event latency at the cost of CPU time. Raising it above the net.core.busy_read sysctl may require CAP_NET_ADMIN.
+        :param timestamp_format: default 'datetime'. With 'raw', the event timestamp is passed on as FHEM's local time string 'YYYY-MM-DD hh:mm:ss' (optionally with fractional seconds), which saves parsing for consumers that don't need a datetime.
         """
         # self.set_loglevel(loglevel)
         self.log = logging.getLogger("FhemEventQueue")
+        self._stop = threading.Event()
+        self.EventThread = None
         self.informcmd = "inform timer"
         self.timeout = timeout
         if serverregex is not None:
@@ -801,6 +1221,11 @@ class FhemEventQueue:
         if protocol != "telnet":
             self.log.error("ONLY TELNET is currently supported for EventQueue")
             return
+        if timestamp_format not in ("datetime", "raw"):
+            self.log.error(
+                "Invalid timestamp_format: %s, using 'datetime'", timestamp_format
+            )
+        raw_timestamp = timestamp_format == "raw"
         self.fhem = Fhem(
             server=server,
             port=port,
@@ -809,14 +1234,23 @@ class FhemEventQueue:
             password=password,
             cafile=cafile,
             loglevel=loglevel,
+            busy_poll_us=busy_poll_us,
         )
         self.fhem.connect()
         time.sleep(timeout)
         self.EventThread = threading.Thread(
             target=self._event_worker_thread,
-            args=(que, filterlist, timeout, eventtimeout, raw_value),
+            args=(
+                que,
+                filterlist,
+                timeout,
+                eventtimeout,
+                raw_value,
+                event_tuples,
+                raw_timestamp,
+            ),
+            daemon=True,
         )
-        self.EventThread.setDaemon(True)
         self.EventThread.start()
 
     def set_loglevel(self, level):
@@ -828,164 +1262,274 @@ class FhemEventQueue:
         self.log.warning(
             "Deprecation: please set logging levels using python's standard logging for logger 'FhemEventQueue'"
         )
-        if level == 0:
-            self.log.setLevel(logging.CRITICAL)
-        elif level == 1:
-            self.log.setLevel(logging.ERROR)
-        elif level == 2:
-            self.log.setLevel(logging.INFO)
-        elif level == 3:
-            self.log.setLevel(logging.DEBUG)
+        if level in _LOGLEVELS:
+            self.log.setLevel(_LOGLEVELS[level])
+
+    @staticmethod
+    def _put_many(que, events):
+        """Queue all events received in one go with a single lock acquisition."""
+        que_type = type(que)
+        if que_type is collections.deque:
+            # atomic, needs no lock
+            que.extend(events)
+        elif que_type is queue.Queue and que.maxsize <= 0:
+            # Same as Queue.put() for all events, but locking only once. Not
+            # for subclasses, they may override put() or the storage.
+            with que.not_empty:
+                for ev in events:
+                    que._put(ev)
+                que.unfinished_tasks += len(events)
+                que.not_empty.notify(len(events))
+        elif hasattr(que, "put"):
+            for ev in events:
+                que.put(ev)
+        else:
+            for ev in events:
+                que.append(ev)
 
     def _event_worker_thread(
-        self, que, filterlist, timeout=0.1, eventtimeout=120, raw_value=False
+        self,
+        que,
+        filterlist,
+        timeout=0.1,
+        eventtimeout=120,
+        raw_value=False,
+        event_tuples=False,
+        raw_timestamp=False,
     ):
         self.log.debug("FhemEventQueue worker thread starting...")
+        filters = _compile_filters(filterlist)
         if self.fhem.connected() is not True:
             self.log.warning("EventQueueThread: Fhem is not connected!")
-        time.sleep(timeout)
+        stop = self._stop
+        stop.wait(timeout)
         self.fhem.send_cmd(self.informcmd)
-        data = ""
+        data = b""
+        # incomplete last line of a receive, completed by the next one
+        tail = b""
         first = True
-        lastreceive = time.time()
-        self.eventThreadActive = True
-        while self.eventThreadActive is True:
-            while self.fhem.connected() is not True:
-                self.fhem.connect()
-                if self.fhem.connected():
-                    time.sleep(timeout)
-                    lastreceive = time.time()
+        # monotonic clock: the inform refresh must not depend on clock changes
+        lastreceive = time.monotonic()
+        # local names for functions used in the loop, saves attribute lookups
+        connected = self.fhem.connected
+        readable = self.fhem._readable
+        recv = self.fhem._recv_chunk
+        monotonic = time.monotonic
+        parse_line = _parse_inform_line
+        while not stop.is_set():
+            while connected() is not True and not stop.is_set():
+                try:
+                    self.fhem.connect()
+                except OSError as err:
+                    self.log.debug("EventQueue: connect failed: %s", err)
+                if connected():
+                    stop.wait(timeout)
+                    lastreceive = monotonic()
                     self.fhem.send_cmd(self.informcmd)
                 else:
                     self.log.warning(
                         "Fhem is not connected in EventQueue thread, retrying!"
                     )
-                    time.sleep(5.0)
+                    # retry after 5 sec, close() ends the wait at once
+                    if stop.wait(5.0):
+                        break
+            if stop.is_set():
+                break
             if first is True:
                 first = False
                 self.log.debug("FhemEventQueue worker thread active.")
-                time.sleep(timeout)
-            if time.time() - lastreceive > eventtimeout:
+                stop.wait(timeout)
+            now = monotonic()
+            if now - lastreceive > eventtimeout:
                 self.log.debug("Event-timeout, refreshing INFORM TIMER")
                 self.fhem.send_cmd(self.informcmd)
-                if self.fhem.connected() is True:
-                    lastreceive = time.time()
-
-            if self.fhem.connected() is True:
-                data = self.fhem._recv_nonblocking(timeout)
-                lines = data.decode("utf-8").split("\n")
-                for l in lines:
-                    if len(l) > 0:
-                        lastreceive = time.time()
-                        li = l.split(" ")
-                        if len(li) > 4:
-                            dd = li[0].split("-")
-                            tt = li[1].split(":")
-                            try:
-                                if "." in tt[2]:
-                                    secs = float(tt[2])
-                                    tt[2] = str(int(secs))
-                                    tt.append(str(int((secs - int(secs)) * 1000000)))
-                            except Exception as e:
-                                self.log.warning(
-                                    "EventQueue: us-Bugfix failed with {}".format(e)
-                                )
-                            try:
-                                if len(tt) == 3:
-                                    dt = datetime.datetime(
-                                        int(dd[0]),
-                                        int(dd[1]),
-                                        int(dd[2]),
-                                        int(tt[0]),
-                                        int(tt[1]),
-                                        int(tt[2]),
-                                    )
-                                else:
-                                    dt = datetime.datetime(
-                                        int(dd[0]),
-                                        int(dd[1]),
-                                        int(dd[2]),
-                                        int(tt[0]),
-                                        int(tt[1]),
-                                        int(tt[2]),
-                                        int(tt[3]),
-                                    )
-                            except Exception as e:
-                                self.log.debug(
-                                    "EventQueue: invalid date format in date={} time={}, event {} ignored: {}".format(
-                                        li[0], li[1], l, e
-                                    )
-                                )
-                                continue
-                            devtype = li[2]
-                            dev = li[3]
-                            val = ""
-                            for i in range(4, len(li)):
-                                val += li[i]
-                                if i < len(li) - 1:
-                                    val += " "
-                            full_val = val
-                            vl = val.split(" ")
-                            val = ""
-                            unit = ""
-                            if len(vl) > 0:
-                                if len(vl[0]) > 0 and vl[0][-1] == ":":
-                                    read = vl[0][:-1]
-                                    if len(vl) > 1:
-                                        val = vl[1]
-                                    if len(vl) > 2:
-                                        unit = vl[2]
-                                else:
-                                    read = "STATE"
-                                    if len(vl) > 0:
-                                        val = vl[0]
-                                    if len(vl) > 1:
-                                        unit = vl[1]
-
-                                adQ = True
-                                if filterlist is not None:
-                                    adQ = False
-                                    for f in filterlist:
-                                        adQt = True
-                                        for c in f:
-                                            if c == "devtype":
-                                                if devtype != f[c]:
-                                                    adQt = False
-                                            if c == "device":
-                                                if dev != f[c]:
-                                                    adQt = False
-                                            if c == "reading":
-                                                if read != f[c]:
-                                                    adQt = False
-                                        if adQt:
-                                            adQ = True
-                                if adQ:
-                                    if raw_value is False:
-                                        ev = {
-                                            "timestamp": dt,
-                                            "devicetype": devtype,
-                                            "device": dev,
-                                            "reading": read,
-                                            "value": val,
-                                            "unit": unit,
-                                        }
-                                    else:
-                                        ev = {
-                                            "timestamp": dt,
-                                            "devicetype": devtype,
-                                            "device": dev,
-                                            "reading": read,
-                                            "value": full_val,
-                                            "unit": None,
-                                        }
-                                    que.put(ev)
-                                    # self.log.debug("Event queued for {}".format(ev['device']))
-            time.sleep(timeout)
-        self.fhem.close()
+                if connected() is True:
+                    lastreceive = now
+
+            if connected() is True:
+                # Block until data arrives, wake up in time for the inform refresh
+                if not readable(eventtimeout / 2):
+                    continue
+                try:
+                    data = recv()
+                except OSError as err:
+                    self.log.debug("EventQueue: receive failed: %s", err)
+                    data = b""
+                if len(data) == 0:
+                    if not stop.is_set():
+                        self.log.warning("EventQueue: connection lost, reconnecting")
+                    self.fhem.close()
+                    tail = b""
+                    continue
+                lastreceive = monotonic()
+                if len(tail) > 0:
+                    data = tail + data
+                # split bytes first, only non-empty lines are decoded. The
+                # last element is the (possibly empty) incomplete line.
+                lines = data.split(b"\n")
+                tail = lines.pop()
+                batch = []
+                for lb in lines:
+                    if len(lb) > 0:
+                        ev = parse_line(
+                            lb, filters, raw_value, event_tuples, raw_timestamp
+                        )
+                        if ev is not None:
+                            batch.append(ev)
+                if len(batch) > 0:
+                    self._put_many(que, batch)
+        if connected():
+            self.fhem.close()
         self.log.debug("FhemEventQueue worker thread terminated.")
         return
 
     def close(self):
         """Stop event thread and close socket."""
-        self.eventThreadActive = False
-        time.sleep(0.5 + self.timeout)
+        self._stop.set()
+        # Wake up the worker thread waiting for data
+        try:
+            self.fhem.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        if self.EventThread is not None:
+            self.EventThread.join(timeout=0.5 + self.timeout)
+
+
+class FhemEventStream:
+    """Receives FHEM events with asyncio. Event streams of several FHEM
+    servers can share one event loop instead of a thread per server."""
+
+    def __init__(
+        self,
+        server,
+        port=7072,
+        use_ssl=False,
+        password="",
+        cafile="",
+        filterlist=None,
+        eventtimeout=60,
+        serverregex=None,
+        raw_value=False,
+        event_tuples=False,
+        timestamp_format="datetime",
+    ):
+        """
+        Construct an event stream object, iterate over the events with `async for ev in stream.events()`.
+
+        :param server: FHEM server address
+        :param port: FHEM telnet port
+        :param use_ssl: boolean for SSL (TLS)
+        :param password: (global) telnet password
+        :param cafile: path to public certificate of your root authority, if left empty, certificate checks are disabled.
+        :param filterlist: array of filter dictionaries, see :py:class:`FhemEventQueue`
+        :param eventtimeout: larger timeout for server keep-alive messages
+        :param serverregex: FHEM regex to restrict event messages on server side.
+        :param raw_value: default False. On True, the value of a reading is not parsed for units, and returned as-is.
+        :param event_tuples: default False. On True, events are FhemEvent namedtuples instead of dictionaries.
+        :param timestamp_format: default 'datetime', 'raw' passes FHEM's timestamp string, see :py:class:`FhemEventQueue`
+        """
+        self.log = logging.getLogger("FhemEventStream")
+        self.server = server
+        self.port = port
+        self.use_ssl = use_ssl
+        self.password = password
+        self.cafile = cafile
+        self.filters = _compile_filters(filterlist)
+        self.eventtimeout = eventtimeout
+        self.informcmd = "inform timer"
+        if serverregex is not None:
+            self.informcmd += " " + serverregex
+        self.raw_value = raw_value
+        self.event_tuples = event_tuples
+        if timestamp_format not in ("datetime", "raw"):
+            self.log.error(
+                "Invalid timestamp_format: %s, using 'datetime'", timestamp_format
+            )
+        self.raw_timestamp = timestamp_format == "raw"
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        """Connect to the FHEM telnet port and start the event subscription."""
+        if self.use_ssl:
+            sslctx = _ssl_context(self.cafile)
+            hostname = self.server
+        else:
+            sslctx = None
+            hostname = None
+        self.reader, self.writer = await asyncio.open_connection(
+            self.server, self.port, ssl=sslctx, server_hostname=hostname
+        )
+        sock = self.writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.password != "":
+            # FHEM's telnet sends 'Password: ' and answers a correct
+            # password with a line break.
+            await asyncio.wait_for(self.reader.readuntil(b"Password: "), 5.0)
+            self.writer.write(self.password.encode("utf-8") + b"\n")
+            await asyncio.wait_for(self.reader.readuntil(b"\n"), 5.0)
+        self.writer.write(self.informcmd.encode("utf-8") + b"\n")
+        await self.writer.drain()
+        self.log.info("Connected to %s:%s", self.server, self.port)
+
+    async def close(self):
+        """Close the connection, a running events() iteration reconnects."""
+        writer = self.writer
+        self.reader = None
+        self.writer = None
+        if writer is not None:
+            writer.close()
+            if hasattr(writer, "wait_closed"):  # Python 3.7+
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
+
+    async def events(self):
+        """
+        Async generator of FHEM events, (re-)connects as needed.
+
+        :return: event dictionaries (or FhemEvent with event_tuples)
+        """
+        while True:
+            if self.reader is None:
+                try:
+                    await self.connect()
+                except (
+                    OSError,
+                    asyncio.TimeoutError,
+                    asyncio.IncompleteReadError,
+                ) as err:
+                    self.log.warning(
+                        "Failed to connect to %s:%s: %s, retrying",
+                        self.server,
+                        self.port,
+                        err,
+                    )
+                    await self.close()
+                    await asyncio.sleep(5.0)
+                    continue
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.eventtimeout)
+            except asyncio.TimeoutError:
+                self.log.debug("Event-timeout, refreshing INFORM TIMER")
+                self.writer.write(self.informcmd.encode("utf-8") + b"\n")
+                continue
+            except (OSError, ValueError) as err:
+                self.log.debug("EventStream: receive failed: %s", err)
+                line = b""
+            if len(line) == 0:
+                self.log.warning("EventStream: connection lost, reconnecting")
+                await self.close()
+                continue
+            ev = _parse_inform_line(
+                line.rstrip(b"\n"),
+                self.filters,
+                self.raw_value,
+                self.event_tuples,
+                self.raw_timestamp,
+            )
+            if ev is not None:
+                yield ev
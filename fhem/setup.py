@@ -22,4 +22,5 @@ setuptools.setup(
     package_dir={"": "."},
     packages=setuptools.find_packages(where="."),
     python_requires=">=3.6",
+    extras_require={"fast": ["orjson"]},
 )
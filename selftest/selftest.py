@@ -1,3 +1,6 @@
+import asyncio
+import collections
+import datetime
 import os
 import sys
 import shutil
@@ -134,6 +137,31 @@ def set_reading(fhi, name, reading, value):
     fhi.send_cmd("setreading {} {} {}".format(name, reading, value))
 
 
+def first_queued_event(fhi, que, name, reading, value):
+    """Change a reading and return the first event of the queue, None on timeout."""
+    time.sleep(1.0)
+    set_reading(fhi, name, reading, value)
+    try:
+        return que.get(timeout=3.0)
+    except queue.Empty:
+        return None
+
+
+async def first_stream_event(stream, fhi, name, reading, value):
+    """Connect the event stream, change a reading and return the first event."""
+    await stream.connect()
+    await asyncio.sleep(0.5)
+    set_reading(fhi, name, reading, value)
+    events = stream.events()
+    try:
+        return await asyncio.wait_for(events.__anext__(), 3.0)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        await events.aclose()
+        await stream.close()
+
+
 def create_device(fhi, name, readings):
     fhi.send_cmd("define {} dummy".format(name))
     fhi.send_cmd("attr {} setList state:on,off".format(name))
@@ -361,6 +389,48 @@ if __name__ == "__main__":
             log.info("states received: {}, ok.".format(len(states)))
         fh.close()
 
+    log.info("---------------Filters-------------------------")
+    fh = fhem.Fhem(config["testhost"], **connections[0])
+    devices = fh.get(name={"clima_sensor1"})
+    if len(devices) != 1 or devices[0]["Name"] != "clima_sensor1":
+        log.error("get() with a set of names failed: {}".format(devices))
+        sys.exit(-9)
+    else:
+        log.info("get() with a set of names: ok.")
+    sent = []
+    send_recv_cmd = fh.send_recv_cmd
+
+    def recording_send_recv_cmd(cmd, **kwargs):
+        sent.append(cmd)
+        return send_recv_cmd(cmd, **kwargs)
+
+    fh.send_recv_cmd = recording_send_recv_cmd
+    fh.get(filters={"room": ["x"]})
+    fh.send_recv_cmd = send_recv_cmd
+    if sent != ["jsonlist2 room~['x']"]:
+        log.error("Filter values must be formatted as given: {}".format(sent))
+        sys.exit(-9)
+    else:
+        log.info("get() with a list as filter value: ok.")
+    spec = ("clima_sensor.*", "temperature")
+    temps = fh.get_many([spec], value_only=True)
+    expected = {
+        dev["name"]: {"temperature": dev["readings"]["temperature"]} for dev in devs
+    }
+    if temps != {spec: expected}:
+        log.error("get_many() failed: {} != {}".format(temps, {spec: expected}))
+        sys.exit(-9)
+    else:
+        log.info("get_many() of all temperature readings: ok.")
+    if fh.get_many([spec], name="clima_sensor1") != {} or (
+        fh.get_many([spec], raw_result=True) != {}
+    ):
+        log.error("get_many() must reject name and raw_result")
+        sys.exit(-9)
+    else:
+        log.info("get_many() rejects name and raw_result: ok.")
+    fh.close()
+
     log.info("---------------MultiConnect--------------------")
     fhm = []
     for connection in connections[-2:]:
@@ -482,5 +552,103 @@ if __name__ == "__main__":
         fq.close()
         time.sleep(0.5)
 
+    telnet = {"protocol": "telnet", "port": 7072}
+    event_filter = [{"device": "clima_sensor1", "reading": "temperature"}]
+
+    log.info("---------------EventStream---------------------")
+    log.info("Testing python-fhem asyncio FhemEventStream():")
+    fh = fhem.Fhem(config["testhost"], **connections[0])
+    stream = fhem.FhemEventStream(
+        config["testhost"], port=telnet["port"], filterlist=event_filter
+    )
+    loop = asyncio.new_event_loop()
+    ev = loop.run_until_complete(
+        first_stream_event(stream, fh, "clima_sensor1", "temperature", 20.5)
+    )
+    loop.close()
+    fh.close()
+    if ev is None or ev["device"] != "clima_sensor1" or ev["value"] != "20.5":
+        log.error("FhemEventStream failed, event: {}".format(ev))
+        sys.exit(-10)
+    if stream.writer is not None:
+        log.error("FhemEventStream is still connected after close()")
+        sys.exit(-10)
+    log.info("EventStream test success, Ok.")
+
+    log.info("---------------EventTuples---------------------")
+    fh = fhem.Fhem(config["testhost"], **connections[0])
+    que = queue.Queue()
+    fq = fhem.FhemEventQueue(
+        config["testhost"], que, filterlist=event_filter, event_tuples=True, **telnet
+    )
+    ev = first_queued_event(fh, que, "clima_sensor1", "temperature", 21.5)
+    fq.close()
+    fh.close()
+    if (
+        not isinstance(ev, fhem.FhemEvent)
+        or not isinstance(ev.timestamp, datetime.datetime)
+        or (ev.devicetype, ev.device, ev.reading, ev.value, ev.unit)
+        != ("dummy", "clima_sensor1", "temperature", "21.5", "")
+    ):
+        log.error("FhemEventQueue with event_tuples failed, event: {}".format(ev))
+        sys.exit(-11)
+    log.info("EventTuples test success, Ok.")
+
+    log.info("---------------RawTimestamps-------------------")
+    fh = fhem.Fhem(config["testhost"], **connections[0])
+    que = queue.Queue()
+    fq = fhem.FhemEventQueue(
+        config["testhost"],
+        que,
+        filterlist=event_filter,
+        timestamp_format="raw",
+        **telnet,
+    )
+    ev = first_queued_event(fh, que, "clima_sensor1", "temperature", 22.5)
+    fq.close()
+    fh.close()
+    raw_ok = False
+    if ev is not None and isinstance(ev["timestamp"], str):
+        try:
+            # FHEM's local time string, optionally with fractional seconds
+            datetime.datetime.strptime(ev["timestamp"][:19], "%Y-%m-%d %H:%M:%S")
+            raw_ok = True
+        except ValueError:
+            pass
+    if raw_ok is False:
+        log.error("FhemEventQueue with raw timestamps failed, event: {}".format(ev))
+        sys.exit(-12)
+    log.info("RawTimestamps test success, Ok.")
+
+    log.info("---------------Deque---------------------------")
+    fh = fhem.Fhem(config["testhost"], **connections[0])
+    que = collections.deque()
+    fq = fhem.FhemEventQueue(config["testhost"], que, filterlist=event_filter, **telnet)
+    time.sleep(1.0)
+    set_reading(fh, "clima_sensor1", "temperature", 23.5)
+    ev = None
+    for i in range(30):
+        try:
+            ev = que.popleft()
+            break
+        except IndexError:
+            time.sleep(0.1)
+    fq.close()
+    fh.close()
+    if ev is None or ev["device"] != "clima_sensor1" or ev["value"] != "23.5":
+        log.error("FhemEventQueue with a deque failed, event: {}".format(ev))
+        sys.exit(-13)
+    log.info("Deque test success, Ok.")
+
+    log.info("---------------TLS close-----------------------")
+    que = queue.Queue()
+    fq = fhem.FhemEventQueue(config["testhost"], que, **connections[1])
+    time.sleep(1.0)
+    fq.close()
+    if fq.EventThread.is_alive() or fq.fhem.connected():
+        log.error("FhemEventQueue over TLS didn't close cleanly")
+        sys.exit(-14)
+    log.info("TLS close test success, Ok.")
+
     log.info("All tests successfull.")
     sys.exit(0)